@@ -30,9 +30,9 @@
 
 import os
 import sys
-import dateutil.parser
-import xml.etree.ElementTree
+import array
 import gzip
+from lxml import etree
 
 nss = {'gnc': 'http://www.gnucash.org/XML/gnc',
        'act': 'http://www.gnucash.org/XML/act',
@@ -65,193 +65,383 @@ nss = {'gnc': 'http://www.gnucash.org/XML/gnc',
        'vendor': 'http://www.gnucash.org/XML/vendor', }
 
 
-class DefaultAttributeProducer:
-    def __init__(self, defaultValue):
-        self.__defaultValue = defaultValue
+def _tag(prefix, local):
+    """Returns the fully-qualified ('{uri}local') name of a gnucash tag, so
+    it can be compared directly against an element's tag."""
+    return '{%s}%s' % (nss[prefix], local)
 
-    def __getattr__(self, value):
-        return self.__defaultValue
 
+GNC_BOOK = _tag('gnc', 'book')
+GNC_CMDTY = _tag('gnc', 'commodity')
+GNC_ACCT = _tag('gnc', 'account')
+GNC_TRN = _tag('gnc', 'transaction')
 
-def orElse(var, default=''):
-    if var is None:
-        return DefaultAttributeProducer(default)
-    else:
-        return var
+GZIP_MAGIC = b'\x1f\x8b'
+
+CMDTY_SPACE = _tag('cmdty', 'space')
+CMDTY_ID = _tag('cmdty', 'id')
+CMDTY_NAME = _tag('cmdty', 'name')
+
+ACT_NAME = _tag('act', 'name')
+ACT_ID = _tag('act', 'id')
+ACT_DESCRIPTION = _tag('act', 'description')
+ACT_TYPE = _tag('act', 'type')
+ACT_PARENT = _tag('act', 'parent')
+ACT_COMMODITY = _tag('act', 'commodity')
+
+SPLIT_RECONCILED = _tag('split', 'reconciled-state')
+SPLIT_ACCOUNT = _tag('split', 'account')
+SPLIT_VALUE = _tag('split', 'value')
+SPLIT_QUANTITY = _tag('split', 'quantity')
+
+TRN_DATE = _tag('trn', 'date-posted')
+TRN_CURRENCY = _tag('trn', 'currency')
+TRN_DESCRIPTION = _tag('trn', 'description')
+TRN_SPLITS = _tag('trn', 'splits')
+TRN_SPLIT = _tag('trn', 'split')
+TS_DATE = _tag('ts', 'date')
+
+
+def childText(e, tag, default=None):
+    """Returns the text of the first child of `e` with the given tag, or
+    `default` if there is none."""
+    for c in e:
+        if c.tag == tag:
+            return c.text
+    return default
+
+
+def intern(text):
+    """Interns `text` (see sys.intern), letting None (an empty or missing
+    element) through unchanged."""
+    return sys.intern(text) if text is not None else None
 
 
 class Commodity:
+    __slots__ = ('space', 'id', 'name')
+
     def __init__(self, e):
         """From a XML e representing a commodity, generates a representation of
         the commodity
         """
 
-        self.space = orElse(e.find('cmdty:space', nss)).text
-        self.id = orElse(e.find('cmdty:id', nss)).text
-        self.name = orElse(e.find('cmdty:name', nss)).text
+        self.space = ''
+        self.id = ''
+        self.name = ''
+        # Go through the children only once, picking the fields we need
+        for c in e:
+            tag = c.tag
+            if tag == CMDTY_SPACE:
+                self.space = intern(c.text)
+            elif tag == CMDTY_ID:
+                self.id = intern(c.text)
+            elif tag == CMDTY_NAME:
+                self.name = c.text
 
     def toLedgerFormat(self, indent=0):
         """Format the commodity in a way good to be interpreted by ledger.
 
         If provided, `indent` will be the indentation (in spaces) of the entry.
         """
-        outPattern = ('{spaces}commodity {id}\n'
-                      '{spaces}  note {name} ({space}:{id})\n')
-        return outPattern.format(spaces=' '*indent, **self.__dict__)
+        spaces = ' '*indent
+        return (f'{spaces}commodity {self.id}\n'
+                f'{spaces}  note {self.name} ({self.space}:{self.id})\n')
 
 
 class Account:
+    __slots__ = ('accountDb', 'name', 'id', 'description', 'type', 'parent',
+                 'commodity', '_fullName')
+
     def __init__(self, accountDb, e):
         self.accountDb = accountDb
-        self.name = e.find('act:name', nss).text
-        self.id = e.find('act:id', nss).text
+        self.name = None
+        self.id = None
+        self.description = ''
+        self.type = None
+        self.parent = None
+        self.commodity = None
+        self._fullName = None  # Computed on first use, see fullName()
+        for c in e:
+            tag = c.tag
+            if tag == ACT_NAME:
+                self.name = c.text
+            elif tag == ACT_ID:
+                self.id = intern(c.text)
+            elif tag == ACT_DESCRIPTION:
+                self.description = c.text
+            elif tag == ACT_TYPE:
+                self.type = intern(c.text)
+            elif tag == ACT_PARENT:
+                self.parent = c.text
+            elif tag == ACT_COMMODITY:
+                self.commodity = intern(childText(c, CMDTY_ID))
         self.accountDb[self.id] = self
-        self.description = orElse(e.find('act:description', nss)).text
-        self.type = e.find('act:type', nss).text
-        self.parent = orElse(e.find('act:parent', nss), None).text
-        self.used = False  # Mark accounts that were in a transaction
-        self.commodity = orElse(e.find('act:commodity/cmdty:id', nss), None).text
 
     def getParent(self):
         return self.accountDb[self.parent]
 
     def fullName(self):
-        if self.parent is not None and self.getParent().type != 'ROOT':
-            prefix = self.getParent().fullName() + ':'
-        else:
-            prefix = ''  # ROOT will not be displayed
-        return prefix + self.name
+        if self._fullName is None:
+            if self.parent is not None and self.getParent().type != 'ROOT':
+                prefix = self.getParent().fullName() + ':'
+            else:
+                prefix = ''  # ROOT will not be displayed
+            self._fullName = prefix + self.name
+        return self._fullName
 
     def toLedgerFormat(self, indent=0):
-        outPattern = ('{spaces}account {fullName}\n'
-                      '{spaces}  note {description} (type: {type})\n')
-        return outPattern.format(spaces=' '*indent, fullName=self.fullName(),
-                                 **self.__dict__)
+        spaces = ' '*indent
+        return (f'{spaces}account {self.fullName()}\n'
+                f'{spaces}  note {self.description} (type: {self.type})\n')
 
 
 class Split:
     """Represents a single split in a transaction"""
 
-    def __init__(self, accountDb, e):
-        self.accountDb = accountDb
-        self.reconciled = e.find('split:reconciled-state', nss).text == 'y'
-        self.accountId = e.find('split:account', nss).text
-        accountDb[self.accountId].used = True
+    __slots__ = ('account', 'reconciled', 'value', 'quantity')
+
+    def __init__(self, account, reconciled, value, quantity):
+        self.account = account
+        self.reconciled = reconciled
+        self.value = value
+        self.quantity = quantity
 
-        # Some special treatment for value and quantity
-        rawValue = e.find('split:value', nss).text
-        self.value = self.convertValue(rawValue)
 
-        # Quantity is the amount on the commodity of the account
-        rawQuantity = e.find('split:quantity', nss).text
-        self.quantity = self.convertValue(rawQuantity)
+class SameCommoditySplit(Split):
+    """A split whose account is in the transaction's currency"""
 
-    def getAccount(self):
-        return self.accountDb[self.accountId]
+    __slots__ = ()
 
     def toLedgerFormat(self, commodity='$', indent=0):
-        outPattern = '{spaces}  {flag}{accountName}    {value}'
-
-        # Check if commodity conversion will be needed
-        conversion = ''
-        if commodity == self.getAccount().commodity:
-            value = '{value} {commodity}'.format(commodity=commodity,
-                                                 value=self.value)
-        else:
-            conversion = ' {destValue} "{destCmdty}" @@ {value} {commodity}'
-            realValue = self.value[1:] if self.value.startswith('-') else self.value
-            value = conversion.format(destValue=self.quantity,
-                                      destCmdty=self.getAccount().commodity,
-                                      value=realValue,
-                                      commodity=commodity)
-
-        return outPattern.format(flag='* ' if self.reconciled else '',
-                                 spaces=indent*' ',
-                                 accountName=self.getAccount().fullName(),
-                                 conversion=conversion,
-                                 value=value)
-
-    def convertValue(self, rawValue):
-        (intValue, decPoint) = rawValue.split('/')
-
-        n = len(decPoint) - 1
-        signFlag = intValue.startswith('-')
-        if signFlag:
-            intValue = intValue[1:]
-        if len(intValue) < n+1:
-            intValue = '0'*(n+1-len(intValue)) + intValue
-        if signFlag:
-            intValue = '-' + intValue
-        return intValue[:-n] + '.' + intValue[-n:]
-
-class Transaction:
-    def __init__(self, accountDb, e):
-        self.accountDb = accountDb
-        self.date = dateutil.parser.parse(e.find('trn:date-posted/ts:date',
-                                                 nss).text)
-        self.commodity = e.find('trn:currency/cmdty:id', nss).text
-        self.description = e.find('trn:description', nss).text
-        self.splits = [Split(accountDb, s)
-                       for s in e.findall('trn:splits/trn:split', nss)]
+        spaces = ' '*indent
+        flag = '* ' if self.reconciled else ''
+        return (f'{spaces}  {flag}{self.account.fullName()}'
+                f'    {self.value} {commodity}')
 
-    def toLedgerFormat(self, indent=0):
-        outPattern = ('{spaces}{date} {description}\n'
-                      '{splits}\n')
-        splits = '\n'.join(s.toLedgerFormat(self.commodity, indent)
-                           for s in self.splits)
-        return outPattern.format(
-            spaces=' '*indent,
-            date=self.date.strftime('%Y/%m/%d'),
-            description=self.description,
-            splits=splits)
-
-def read_file(file_name):
-    try:
-        with gzip.open(file_name, 'rt') as f:
-            return f.read()
-    except gzip.BadGzipFile:
-        with open(file_name, 'r') as f:
-            return f.read()
-
-
-def convert2Ledger(inputFile):
-    """Reads a gnucash file and converts it to a ledger file."""
-    file = read_file(inputFile)
-
-    e = xml.etree.ElementTree.fromstring(file)
-    b = e.find('gnc:book', nss)
-
-    # Find all commodities
-    commodities = []
-    for cmdty in b.findall('gnc:commodity', nss):
-        commodities.append(Commodity(cmdty))
 
-    # Find all accounts
-    accountDb = {}
-    for acc in b.findall('gnc:account', nss):
-        Account(accountDb, acc)
+class ConversionSplit(Split):
+    """A split whose account is in a different commodity than the
+    transaction's currency"""
+
+    __slots__ = ()
+
+    def toLedgerFormat(self, commodity='$', indent=0):
+        realValue = self.value[1:] if self.value.startswith('-') else self.value
+        spaces = ' '*indent
+        flag = '* ' if self.reconciled else ''
+        return (f'{spaces}  {flag}{self.account.fullName()}'
+                f'     {self.quantity} "{self.account.commodity}"'
+                f' @@ {realValue} {commodity}')
+
+
+# Number of decimal places for each (power of ten) denominator seen so far
+_decimalPlaces = {}
+
+
+def convertValue(rawValue):
+    """Converts a gnucash amount ('numerator/denominator', the denominator
+    being a power of ten) to a decimal string."""
+    (numerator, denominator) = rawValue.split('/', 1)
+
+    n = _decimalPlaces.get(denominator)
+    if n is None:
+        n = len(denominator) - 1
+        if int(denominator) != 10**n:
+            raise ValueError('Unsupported denominator in value: ' + rawValue)
+        _decimalPlaces[denominator] = n
 
-    # Finally, find all transactions
-    transactions = []
-    for xact in b.findall('gnc:transaction', nss):
-        transactions.append(Transaction(accountDb, xact))
+    intValue = int(numerator)
+    if n == 0:
+        return str(intValue)
+    digits = str(abs(intValue)).rjust(n+1, '0')
+    sign = '-' if intValue < 0 else ''
+    return sign + digits[:-n] + '.' + digits[-n:]
+
+
+class Transactions:
+    """Holds all the transactions of a book as parallel columns.
+
+    Transaction `i` has its raw posted date, description and currency at index
+    `i` of the corresponding lists, and its splits are
+    `splits[splitOffsets[i]:splitOffsets[i+1]]`.
+    """
+
+    __slots__ = ('accountDb', 'usedIds', 'rawDates', 'descriptions',
+                 'currencies', 'splitOffsets', 'splits')
+
+    def __init__(self, accountDb, usedIds):
+        self.accountDb = accountDb
+        self.usedIds = usedIds  # Ids of the accounts found in a transaction
+        self.rawDates = []
+        self.descriptions = []
+        self.currencies = []
+        self.splitOffsets = array.array('i', [0])
+        self.splits = []
+
+    def __len__(self):
+        return len(self.rawDates)
+
+    def append(self, e):
+        """Adds the transaction represented by the XML e"""
+        splits = ()
+        for c in e:
+            tag = c.tag
+            if tag == TRN_DATE:
+                # Gnucash always writes dates as 'YYYY-MM-DD HH:MM:SS +HHMM',
+                # so the local date and time sort correctly as a string
+                rawDate = childText(c, TS_DATE)[:19]
+            elif tag == TRN_CURRENCY:
+                # Commodity and account ids repeat all over the book:
+                # interning them saves memory and lets comparisons and lookups
+                # succeed on identity
+                currency = intern(childText(c, CMDTY_ID))
+            elif tag == TRN_DESCRIPTION:
+                description = c.text
+            elif tag == TRN_SPLITS:
+                splits = c
+
+        # Splits are built once the currency is known
+        for s in splits:
+            if s.tag != TRN_SPLIT:
+                continue
+            for c in s:
+                tag = c.tag
+                if tag == SPLIT_RECONCILED:
+                    reconciled = c.text == 'y'
+                elif tag == SPLIT_ACCOUNT:
+                    accountId = intern(c.text)
+                elif tag == SPLIT_VALUE:
+                    rawValue = c.text
+                elif tag == SPLIT_QUANTITY:
+                    rawQuantity = c.text
+            self.usedIds.add(accountId)
+
+            # Some special treatment for value and quantity. Quantity is the
+            # amount on the commodity of the account, which most of the time
+            # is the same as the value
+            value = convertValue(rawValue)
+            if rawQuantity == rawValue:
+                quantity = value
+            else:
+                quantity = convertValue(rawQuantity)
+
+            # Check now if commodity conversion will be needed, so that
+            # formatting does not have to
+            account = self.accountDb[accountId]
+            if account.commodity == currency:
+                splitClass = SameCommoditySplit
+            else:
+                splitClass = ConversionSplit
+            self.splits.append(splitClass(account, reconciled, value,
+                                          quantity))
+
+        self.rawDates.append(rawDate)
+        self.descriptions.append(description)
+        self.currencies.append(currency)
+        self.splitOffsets.append(len(self.splits))
+
+    def dateOrder(self):
+        """Returns the indexes of the transactions sorted by posted date"""
+        return sorted(range(len(self.rawDates)),
+                      key=self.rawDates.__getitem__)
+
+    def toLedgerFormat(self, i, indent=0):
+        """Format transaction `i` in a way good to be interpreted by ledger."""
+        currency = self.currencies[i]
+        splits = '\n'.join(s.toLedgerFormat(currency, indent)
+                           for s in self.splits[self.splitOffsets[i]:
+                                                self.splitOffsets[i+1]])
+        spaces = ' '*indent
+        date = self.rawDates[i][:10].replace('-', '/')
+        return f'{spaces}{date} {self.descriptions[i]}\n{splits}\n'
+
+
+def open_file(file_name):
+    """Opens a gnucash file for binary reading, transparently handling
+    compressed files."""
+    with open(file_name, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+def writeJoined(write, entries, separator='\n'):
+    """Calls `write` on each of `entries`, with `separator` in between.
+
+    Equivalent to `write(separator.join(entries))` without building the
+    joined string.
+    """
+    first = True
+    for entry in entries:
+        if not first:
+            write(separator)
+        write(entry)
+        first = False
+
+
+def convert2Ledger(inputFile, outFile=None):
+    """Reads a gnucash file and converts it to a ledger file.
+
+    If `outFile` is given, the ledger is written to it as it is generated and
+    the returned output is None. Otherwise the ledger is returned as a string.
+
+    Returns a tuple (output, commodities, accountDb, transactions), where
+    transactions is a Transactions table.
+    """
+    commodities = []
+    accountDb = {}
+    usedIds = set()
+    transactions = Transactions(accountDb, usedIds)
+
+    # Stream the file, building each object as soon as its element is
+    # complete. Only the direct children of the book are considered (template
+    # transactions, for example, also contain accounts and transactions).
+    # Processed elements are dropped from the book so memory usage stays
+    # bounded by the size of a single record.
+    book = None
+    depth = 0
+    with open_file(inputFile) as f:
+        for event, elem in etree.iterparse(f, events=('start', 'end'),
+                                           collect_ids=False, huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if depth == 2 and elem.tag == GNC_BOOK:
+                    book = elem
+                continue
+
+            depth -= 1
+            if book is None or elem.getparent() is not book:
+                continue
+
+            tag = elem.tag
+            if tag == GNC_CMDTY:
+                commodities.append(Commodity(elem))
+            elif tag == GNC_ACCT:
+                Account(accountDb, elem)
+            elif tag == GNC_TRN:
+                transactions.append(elem)
+            elem.clear()
+            book.remove(elem)
 
     # Generate output
-    output = ''
+    parts = []
+    write = outFile.write if outFile is not None else parts.append
 
     # First, add the commodities definition
-    output = '\n'.join(c.toLedgerFormat() for c in commodities)
-    output += '\n\n'
+    writeJoined(write, (c.toLedgerFormat() for c in commodities))
+    write('\n\n')
 
     # Then, output all accounts
-    output += '\n'.join(a.toLedgerFormat()
-                        for a in accountDb.values() if a.used)
-    output += '\n\n'
+    writeJoined(write, (a.toLedgerFormat()
+                        for aid, a in accountDb.items() if aid in usedIds))
+    write('\n\n')
 
     # And finally, output all transactions
-    output += '\n'.join(t.toLedgerFormat()
-                        for t in sorted(transactions, key=lambda x: x.date))
+    writeJoined(write, (transactions.toLedgerFormat(i)
+                        for i in transactions.dateOrder()))
 
+    output = ''.join(parts) if outFile is None else None
     return (output, commodities, accountDb, transactions)
 
 
@@ -266,11 +456,17 @@ if __name__ == '__main__':
         print('Output file exists. It will not be overwritten.')
         exit(2)
 
-    (data, commodities, accountDb, transactions) = convert2Ledger(sys.argv[1])
-
     if len(sys.argv) == 3:
+        # Output is written while converting, so do not leave a partial file
+        # behind (that would block the next run) if the conversion fails
         with open(sys.argv[2], 'w') as fh:
-            fh.write(data)
+            try:
+                convert2Ledger(sys.argv[1], fh)
+            except BaseException:
+                fh.close()
+                os.remove(sys.argv[2])
+                raise
     else:
-        print(data)
+        convert2Ledger(sys.argv[1], sys.stdout)
+        print()
 